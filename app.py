@@ -1,14 +1,22 @@
 # app.py
 
+import hashlib
+import html
+import io
+import logging
 import os
+from contextlib import contextmanager
 from datetime import date
 
+import numpy as np
 import pandas as pd
+import psycopg2
 import streamlit as st
 from sqlalchemy import create_engine, text
-from sqlalchemy.exc import OperationalError
-from sqlalchemy.exc import IntegrityError, DBAPIError
-from sqlalchemy.pool import NullPool
+from sqlalchemy.exc import DataError, IntegrityError, OperationalError
+from sqlalchemy.exc import TimeoutError as PoolTimeoutError
+
+log = logging.getLogger(__name__)
 
 
 # -----------------------------------------------------------------------------
@@ -37,9 +45,19 @@ DB_URL = os.getenv(
 
 @st.cache_resource
 def get_engine():
+    """
+    One engine per server process, shared by every session and rerun.
+    cache_resource hands back the same object (no copy), which is what an engine needs.
+    """
+    # Pool stays well under the session pooler's client cap (15); psycopg2 never
+    # prepares statements server-side, so pooled connections are pooler-safe.
     return create_engine(
         DB_URL,
-        poolclass=NullPool,              # IMPORTANT: disable client-side pooling
+        pool_pre_ping=True,
+        pool_size=3,
+        max_overflow=2,                  # <= 5 per process leaves room for a redeploy overlap
+        pool_recycle=1800,               # drop connections before the pooler times them out
+        pool_timeout=30,
         connect_args={"sslmode": "require"},
     )
 
@@ -109,6 +127,10 @@ PARTNER_TYPE_TAG_OPTIONS = ["Portfolio", "Longtail"]  # stored in partner.partne
 
 FEEDBACK_FORM_URL = "https://forms.gle/4QpWEUAdxPobT636A"
 
+# Streamlit capabilities don't change at runtime; probe once at import.
+_HAS_DIALOG = hasattr(st, "dialog")
+_HAS_LINK_BUTTON = hasattr(st, "link_button")
+
 
 def ensure_session():
     if "logged_in" not in st.session_state:
@@ -125,6 +147,10 @@ def ensure_session():
         st.session_state.open_status_dialog = False
 
 
+# Fields on_status_change reads, stored per work_item_id (the dict key, not repeated).
+ROW_LOOKUP_COLS = ["partner_id", "external_partner_id", "partner_name", "status"]
+
+
 def on_status_change(work_item_id: str):
     work_item_id = str(work_item_id)
 
@@ -140,15 +166,17 @@ def on_status_change(work_item_id: str):
     if selected_status == row.get("status"):
         return
 
+    user = st.session_state.current_user
     st.session_state.pending_status_payload = {
         "work_item_id": work_item_id,
         "partner_id": str(row.get("partner_id")),
         "external_partner_id": row.get("external_partner_id"),
         "partner_name": row.get("partner_name"),
-        "agent_id": st.session_state.current_user["id"],
-        "agent_name": st.session_state.current_user["name"],
+        "agent_id": user["id"],
+        "agent_name": user["name"],
         "status": selected_status,
     }
+    st.session_state.status_save_warning = None
     st.session_state.open_status_dialog = True
 
 
@@ -159,6 +187,10 @@ def on_status_change(work_item_id: str):
 # -----------------------------------------------------------------------------
 
 def get_connection():
+    """
+    Check a connection out of the shared get_engine() pool (no new TCP/TLS per call).
+    Callers own the transaction; writes normally go through get_transaction().
+    """
     try:
         engine = get_engine()
         return engine.connect()
@@ -166,50 +198,87 @@ def get_connection():
         st.error("DB connection failed. Check Supabase pooler host/username/password.")
         st.exception(e)
         st.stop()
+    except PoolTimeoutError:
+        # All pooled connections stayed busy (e.g. long uploads) for pool_timeout seconds.
+        st.error("Server is busy right now. Please retry in a moment.")
+        st.stop()
+
 
+@contextmanager
+def get_transaction():
+    """
+    One pooled checkout for a whole write flow, inside BEGIN: commits when the block
+    exits cleanly, rolls back if it raises. Replaces connect() + conn.commit().
+    """
+    with get_connection() as conn, conn.begin():
+        yield conn
 
 
-def ensure_workitem_columns():
+def get_ro_connection():
     """
-    Ensure required columns exist without manual migrations.
-    - is_active: used to indicate current board row (kept for backward-compat)
-    - created_at: first time row created (captures when item entered board for that date)
-    - refreshed_at: last time board was refreshed/reset for that date
+    Connection for pure SELECTs. AUTOCOMMIT means psycopg2 sends no BEGIN and the
+    pool sends no ROLLBACK on return, so each read is a single pooler round trip.
     """
-    q = text(
-        """
-        ALTER TABLE public.work_item
-          ADD COLUMN IF NOT EXISTS is_active BOOLEAN DEFAULT TRUE;
+    return get_connection().execution_options(isolation_level="AUTOCOMMIT")
 
-        ALTER TABLE public.work_item
-          ADD COLUMN IF NOT EXISTS created_at TIMESTAMPTZ DEFAULT NOW();
 
-        ALTER TABLE public.work_item
-          ADD COLUMN IF NOT EXISTS refreshed_at TIMESTAMPTZ;
-        """
-    )
-    with get_connection() as conn:
-        conn.execute(q)
-        conn.commit()
+def _fetch_df(conn, q, params=None) -> pd.DataFrame:
+    """
+    Execute + DataFrame.from_records on the raw row tuples; cheaper than pd.read_sql's
+    generic path. coerce_float keeps read_sql's Decimal -> float behaviour.
+    """
+    res = conn.execute(q, params or {})
+    return pd.DataFrame.from_records(res.fetchall(), columns=list(res.keys()), coerce_float=True)
+
+
+WORKITEM_COLUMNS_DDL = """
+    -- is_active: current board row (kept for backward-compat)
+    ALTER TABLE public.work_item
+      ADD COLUMN IF NOT EXISTS is_active BOOLEAN DEFAULT TRUE;
+
+    -- created_at: when the item entered the board for that date
+    ALTER TABLE public.work_item
+      ADD COLUMN IF NOT EXISTS created_at TIMESTAMPTZ DEFAULT NOW();
 
+    -- refreshed_at: last time the board was refreshed/reset for that date
+    ALTER TABLE public.work_item
+      ADD COLUMN IF NOT EXISTS refreshed_at TIMESTAMPTZ;
+"""
 
-def ensure_partner_type_tag_column():
+# Board fetch / reset lookups. CONCURRENTLY so the build doesn't block writes to these
+# tables; that can't run inside a transaction, so these go one statement at a time.
+BOARD_INDEX_DDL = [
     """
-    Ensure partner.partner_type_tag exists (Portfolio / Longtail).
-    Kept permissive: doesn't force check constraint (you can add in Supabase manually).
+    CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_work_item_partner_date
+      ON public.work_item (partner_id, work_date)
+    """,
     """
-    q = text(
-        """
-        ALTER TABLE public.partner
-          ADD COLUMN IF NOT EXISTS partner_type_tag TEXT;
-        """
-    )
-    with get_connection() as conn:
-        conn.execute(q)
-        conn.commit()
+    CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_work_item_active_partner
+      ON public.work_item (partner_id) WHERE is_active
+    """,
+    """
+    CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_pam_agent
+      ON public.partner_agent_map (agent_id)
+    """,
+]
 
-def ensure_activity_log_table():
-    q = text("""
+# Portfolio / Longtail. Kept permissive: no check constraint (add in Supabase manually).
+PARTNER_TYPE_TAG_DDL = """
+    ALTER TABLE public.partner
+      ADD COLUMN IF NOT EXISTS partner_type_tag TEXT;
+"""
+
+# Substring (ILIKE '%...%') search on external_partner_id needs a trigram index.
+# Optional: without it the search still works, it just scans.
+PARTNER_SEARCH_INDEX_DDL = [
+    "CREATE EXTENSION IF NOT EXISTS pg_trgm",
+    """
+    CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_partner_external_id_trgm
+      ON public.partner USING gin (external_partner_id gin_trgm_ops)
+    """,
+]
+
+ACTIVITY_LOG_DDL = """
     CREATE TABLE IF NOT EXISTS work_item_activity_log (
         id UUID DEFAULT gen_random_uuid() PRIMARY KEY,
         work_item_id UUID NOT NULL,
@@ -224,10 +293,64 @@ def ensure_activity_log_table():
         next_suggested_action TEXT,
         created_at TIMESTAMPTZ DEFAULT NOW()
     );
-    """)
-    with get_connection() as conn:
-        conn.execute(q)
-        conn.commit()
+
+    -- latest follow-up per work item (board fetch LATERAL)
+    CREATE INDEX IF NOT EXISTS ix_activity_log_work_item_created
+      ON work_item_activity_log (work_item_id, created_at DESC);
+"""
+
+
+def _run_ddl(*statements: str) -> None:
+    # Multiple statements go out as one simple-protocol query: one round trip, one commit.
+    with get_transaction() as conn:
+        conn.execute(text("\n".join(statements)))
+
+
+def _run_ddl_best_effort(*statements: str) -> bool:
+    """
+    Each statement in its own autocommit round trip; a failure (no privilege, bad
+    column type) is logged and the rest still run. Returns whether all succeeded.
+    """
+    ok = True
+    with get_connection().execution_options(isolation_level="AUTOCOMMIT") as conn:
+        for stmt in statements:
+            try:
+                conn.execute(text(stmt))
+            except Exception:
+                log.warning("Optional DDL failed, continuing without it: %s", stmt.strip(), exc_info=True)
+                ok = False
+    return ok
+
+
+def ensure_board_schema():
+    """
+    Everything the board can't work without (work_item columns, partner_type_tag,
+    activity log) in a single round trip.
+    """
+    _run_ddl(WORKITEM_COLUMNS_DDL, PARTNER_TYPE_TAG_DDL, ACTIVITY_LOG_DDL)
+
+
+@st.cache_resource(show_spinner=False)
+def _schema_ready() -> bool:
+    # Lives for the whole server process, so the DDL runs once, not on every rerun.
+    # A failure isn't cached; the next rerun simply tries again.
+    ensure_board_schema()
+    return True
+
+
+@st.cache_resource(show_spinner=False)
+def _board_indexes_ready() -> bool:
+    # Speed-ups only. Best effort, cached either way: a role that can't create them just
+    # gets slower queries, not a blocked board or a DDL retry on every rerun.
+    return _run_ddl_best_effort(*BOARD_INDEX_DDL, *PARTNER_SEARCH_INDEX_DDL)
+
+
+@st.cache_resource(show_spinner=False)
+def _partner_tag_ready() -> bool:
+    # Uploads only need partner.partner_type_tag, so they don't wait on (or fail with)
+    # the board's extension/index DDL. Same caching as _schema_ready.
+    _run_ddl(PARTNER_TYPE_TAG_DDL)
+    return True
 
 def reset_work_items_for_agent(agent_id: str) -> int:
     """
@@ -249,10 +372,11 @@ def reset_work_items_for_agent(agent_id: str) -> int:
           );
     """)
 
-    with get_connection() as conn:
+    with get_transaction() as conn:
         res = conn.execute(q, {"agent_id": agent_id})
-        conn.commit()
-        return int(res.rowcount or 0)
+
+    fetch_work_items_for_agent.clear()
+    return int(res.rowcount or 0)
 
 
 # -----------------------------------------------------------------------------
@@ -275,9 +399,10 @@ def fetch_agent_dashboard_data(start_date, end_date, agent_id=None):
         q += " AND agent_id = :agent_id"
         params["agent_id"] = agent_id
 
-    with get_connection() as conn:
-        return pd.read_sql(text(q), conn, params=params)
+    with get_ro_connection() as conn:
+        return _fetch_df(conn, text(q), params)
 
+@st.cache_data(ttl=3600, show_spinner=False)
 def fetch_central_farmers() -> pd.DataFrame:
     q = text(
         """
@@ -287,12 +412,120 @@ def fetch_central_farmers() -> pd.DataFrame:
         ORDER BY name;
         """
     )
-    with get_connection() as conn:
-        return pd.read_sql(q, conn)
+    with get_ro_connection() as conn:
+        return _fetch_df(conn, q)
+
+
+# Applied once when the cached board frame is built, not on every rerun.
+# Low-cardinality text -> category (filters compare integer codes), small ints stay small,
+# ids as plain str (widget keys / callback lookup).
+BOARD_DTYPES = {
+    "status": "category",
+    "partner_type": "category",
+    "city": "category",
+    "priority_bucket_key": "category",
+    "work_item_id": str,
+    "partner_id": str,
+    "orders_m0": "int32",
+    "days_since_last_activity": "float32",  # NULL -> NaN, so not an int dtype
+    "rev_m0": "float32",
+    "priority_bucket_rank": "int8",
+}
 
 
-def fetch_work_items_for_agent(agent_id: str) -> pd.DataFrame:
+def _assign_priority_buckets(df: pd.DataFrame) -> pd.DataFrame:
     """
+    Vectorised priority classification + board ordering (see fetch_work_items_for_agent).
+    NULL days_since_last_activity never matches a rule, so it lands in Regular Activation.
+    """
+    days = pd.to_numeric(df["days_since_last_activity"], errors="coerce").to_numpy(dtype="float64")
+    orders = pd.to_numeric(df["orders_m0"], errors="coerce").fillna(0).to_numpy()
+    conds = [
+        (days <= 8) & (orders >= 2),
+        days >= 40,
+        days >= 28,
+        days >= 14,
+        days >= 7,
+    ]
+    df["priority_bucket_key"] = np.select(
+        conds,
+        ["emerging_power_user", "ar40", "ar28", "ar14", "ar7"],
+        default="regular_activation",
+    )
+    df["priority_bucket_rank"] = np.select(conds, [50, 10, 20, 30, 40], default=60)
+    df["rev_m0"] = pd.to_numeric(df["rev_m0"], errors="coerce").fillna(0)
+
+    return df.sort_values(
+        ["priority_bucket_rank", "rev_m0", "days_since_last_activity", "partner_name"],
+        ascending=[True, False, False, True],
+        na_position="last",
+    ).reset_index(drop=True)
+
+
+def _fmt_dt(col: pd.Series) -> pd.Series:
+    """'YYYY-MM-DD HH:MM:SS' display strings for a whole timestamp column, '-' for nulls."""
+    out = col.astype(str).str[:19].str.replace("T", " ", regex=False)
+    return out.where(col.notna(), "-")
+
+
+def _card_html(df: pd.DataFrame) -> pd.Series:
+    """
+    Account card HTML for every row at once (column-wise string ops, run once per board
+    fetch rather than per card per rerun). Card UI: name, external id, bucket, follow-up
+    date, OMS link, first added, last refresh. Uploaded text is escaped since it goes
+    out with unsafe_allow_html.
+    """
+    key = df["priority_bucket_key"].astype(str)
+    color = key.map(PRIORITY_COLOR_BY_KEY).fillna("#616161")
+    label = key.map(PRIORITY_LABEL_BY_KEY).fillna(key)
+
+    name = df["partner_name"].fillna("").astype(str).map(html.escape)
+    ext = df["external_partner_id"].fillna("").astype(str).str.strip().map(html.escape)
+    oms_url = "https://oms.orangehealth.in/partner/" + ext
+
+    follow_up = df["latest_follow_up_date"]
+    follow_up_html = (
+        "<div style='margin-top:6px; font-size:13px;'>🗓️ <b>Follow-up on:</b> <code>"
+        + follow_up.astype(str)
+        + "</code></div>"
+    ).where(df["status"].eq("follow_up") & follow_up.notna(), "")
+
+    oms_html = (
+        "<div style='margin-top:6px;'><a href='" + oms_url + "' target='_blank'>OMS Link: "
+        + oms_url + "</a></div>"
+    ).where(ext.ne(""), "")
+
+    return (
+        '<div style="border-left: 6px solid ' + color + '; padding-left: 10px;">'
+        + '<div style="font-size: 16px; font-weight: 700;">' + name + "</div>"
+        + '<div style="margin-top:2px;"><span style="font-weight:600;">External ID:</span> <code>'
+        + ext.where(ext.ne(""), "-") + "</code></div>"
+        + '<div style="margin-top:2px;"><span style="font-weight:600;">Category:</span> '
+        + '<span style="color:' + color + '; font-weight:800;">' + label + "</span></div>"
+        + "</div>\n"
+        + follow_up_html
+        + oms_html
+        + "<div style='font-size:12px; opacity:0.8;'>First Added: <code>" + df["created_at_fmt"]
+        + "</code> · Last Refresh: <code>" + df["refreshed_at_fmt"] + "</code></div>"
+    )
+
+
+def _escape_like(s: str) -> str:
+    """Make user input match literally inside a LIKE/ILIKE pattern ('_' and '%' are wildcards)."""
+    return s.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+
+
+# cache_resource, not cache_data: every rerun gets the same frame object instead of an
+# unpickled copy. Callers must treat it as read-only (the board only masks/slices it).
+@st.cache_resource(ttl=60, max_entries=200, show_spinner=False)
+def fetch_work_items_for_agent(
+    agent_id: str, ext_id_filter: str | None = None, day: date | None = None
+) -> pd.DataFrame:
+    """
+    ext_id_filter: optional ILIKE pattern on external_partner_id (e.g. "%3579%").
+    day: cache key only (callers pass date.today()), so a cached board never outlives
+    the day its CURRENT_DATE-based priorities were computed for.
+
     Priority rules (exclusive, in order):
     - Emerging Power User: >=2 orders in last 8 days (proxy using MTD orders + recent activity)
     - AR40: last activity >= 40 days ago
@@ -303,7 +536,24 @@ def fetch_work_items_for_agent(agent_id: str) -> pd.DataFrame:
     """
     q = text(
         """
-        WITH base AS (
+        WITH my_partners AS MATERIALIZED (
+          SELECT partner_id
+          FROM partner_agent_map
+          WHERE agent_id = :agent_id
+        ),
+        -- one grouped scan of the agent's monthly metrics instead of a per-partner
+        -- LATERAL (last active month) plus a separate join (current month)
+        pm_agg AS (
+          SELECT
+            pm.partner_id,
+            MAX(pm.orders)      FILTER (WHERE pm.month_date = date_trunc('month', CURRENT_DATE)::date) AS orders_m0,
+            MAX(pm.net_revenue) FILTER (WHERE pm.month_date = date_trunc('month', CURRENT_DATE)::date) AS rev_m0,
+            (MAX(pm.month_date) FILTER (WHERE COALESCE(pm.orders, 0) > 0))::date AS last_active_month
+          FROM partner_monthly_metrics pm
+          JOIN my_partners mp ON mp.partner_id = pm.partner_id
+          GROUP BY pm.partner_id
+        ),
+        base AS (
           SELECT
             wi.id AS work_item_id,
             wi.partner_id,
@@ -322,34 +572,21 @@ def fetch_work_items_for_agent(agent_id: str) -> pd.DataFrame:
             p.handover_status,
             p.last_order_date,
 
-            COALESCE(pm0.orders, 0)      AS orders_m0,
-            COALESCE(pm0.net_revenue, 0) AS rev_m0,
+            COALESCE(pa.orders_m0, 0) AS orders_m0,
+            COALESCE(pa.rev_m0, 0)    AS rev_m0,
             lf.follow_up_date AS latest_follow_up_date,
-            lam.last_active_month,
+            pa.last_active_month,
 
             COALESCE(
               p.last_order_date::date,
-              (lam.last_active_month + interval '1 month - 1 day')::date
-            ) AS last_activity_date,
+              (pa.last_active_month + interval '1 month - 1 day')::date
+            ) AS last_activity_date
 
-            CASE
-              WHEN COALESCE(
-                p.last_order_date::date,
-                (lam.last_active_month + interval '1 month - 1 day')::date
-              ) IS NULL THEN NULL
-              ELSE (CURRENT_DATE::date - COALESCE(
-                p.last_order_date::date,
-                (lam.last_active_month + interval '1 month - 1 day')::date
-              ))::int
-            END AS days_since_last_activity
-
-          FROM work_item wi
-          JOIN partner p ON p.id = wi.partner_id
-          JOIN partner_agent_map pam ON pam.partner_id = p.id
-
-          LEFT JOIN partner_monthly_metrics pm0
-            ON pm0.partner_id = p.id
-           AND pm0.month_date = date_trunc('month', CURRENT_DATE)::date
+          FROM my_partners mp
+          JOIN work_item wi ON wi.partner_id = mp.partner_id
+          JOIN partner p ON p.id = mp.partner_id
+
+          LEFT JOIN pm_agg pa ON pa.partner_id = p.id
             LEFT JOIN LATERAL (
                 SELECT
                     wal.follow_up_date
@@ -360,84 +597,28 @@ def fetch_work_items_for_agent(agent_id: str) -> pd.DataFrame:
                 LIMIT 1
             ) lf ON TRUE
 
-          LEFT JOIN LATERAL (
-            SELECT MAX(pm.month_date)::date AS last_active_month
-            FROM partner_monthly_metrics pm
-            WHERE pm.partner_id = p.id
-              AND COALESCE(pm.orders,0) > 0
-          ) lam ON TRUE
-
-          WHERE pam.agent_id = :agent_id
-            AND wi.is_active = TRUE
+          WHERE wi.is_active = TRUE
+            AND (:ext_id_filter IS NULL OR p.external_partner_id ILIKE :ext_id_filter)
         )
+        -- date - date is an int (NULL stays NULL); computed once from the column above
         SELECT
-          *,
-          CASE
-            WHEN days_since_last_activity IS NOT NULL
-              AND days_since_last_activity <= 8
-              AND orders_m0 >= 2
-              THEN 'emerging_power_user'
-            WHEN days_since_last_activity IS NOT NULL AND days_since_last_activity >= 40 THEN 'ar40'
-            WHEN days_since_last_activity IS NOT NULL AND days_since_last_activity >= 28 THEN 'ar28'
-            WHEN days_since_last_activity IS NOT NULL AND days_since_last_activity >= 14 THEN 'ar14'
-            WHEN days_since_last_activity IS NOT NULL AND days_since_last_activity >= 7  THEN 'ar7'
-            ELSE 'regular_activation'
-          END AS priority_bucket_key,
-
-          CASE
-            WHEN days_since_last_activity IS NOT NULL
-              AND days_since_last_activity <= 8
-              AND orders_m0 >= 2
-              THEN 50
-            WHEN days_since_last_activity IS NOT NULL AND days_since_last_activity >= 40 THEN 10
-            WHEN days_since_last_activity IS NOT NULL AND days_since_last_activity >= 28 THEN 20
-            WHEN days_since_last_activity IS NOT NULL AND days_since_last_activity >= 14 THEN 30
-            WHEN days_since_last_activity IS NOT NULL AND days_since_last_activity >= 7  THEN 40
-            ELSE 60
-          END AS priority_bucket_rank
-
-        FROM base
-        ORDER BY
-          priority_bucket_rank ASC,
-          rev_m0 DESC,
-          days_since_last_activity DESC NULLS LAST,
-          partner_name;
-        """
-    )
-
-    with get_connection() as conn:
-        return pd.read_sql(q, conn, params={"agent_id": agent_id})
-
-
-def update_work_item_status(work_item_id: str, new_status: str) -> None:
-    q = text(
-        """
-        UPDATE work_item
-        SET status = :status,
-            updated_at = NOW()
-        WHERE id = :id;
+          base.*,
+          CURRENT_DATE - base.last_activity_date AS days_since_last_activity
+        FROM base;
         """
     )
 
-    try:
-        with get_connection() as conn:
-            res = conn.execute(q, {"status": new_status, "id": work_item_id})
-            conn.commit()
+    with get_ro_connection() as conn:
+        df = _fetch_df(conn, q, {"agent_id": agent_id, "ext_id_filter": ext_id_filter})
 
-            if hasattr(res, "rowcount") and res.rowcount == 0:
-                st.error(f"No work_item found for id={work_item_id}. Data may be stale; refresh the page.")
-                st.stop()
-
-    except IntegrityError as e:
-        st.error("DB integrity error while updating status.")
-        st.exception(e)
-        st.stop()
-    except DBAPIError as e:
-        st.error("DB error while updating status.")
-        st.exception(e)
-        st.stop()
+    df["created_at_fmt"] = _fmt_dt(df["created_at"])
+    df["refreshed_at_fmt"] = _fmt_dt(df["refreshed_at"])
+    df = _assign_priority_buckets(df)
+    df["card_html"] = _card_html(df)
+    return df.astype(BOARD_DTYPES)
 
 
+@st.cache_data(ttl=300, show_spinner=False)
 def get_user_portfolio(agent_email: str) -> pd.DataFrame:
     q = text(
         """
@@ -464,8 +645,13 @@ def get_user_portfolio(agent_email: str) -> pd.DataFrame:
         ORDER BY p.partner_name;
         """
     )
-    with get_connection() as conn:
-        return pd.read_sql(q, conn, params={"email": agent_email})
+    with get_ro_connection() as conn:
+        df = _fetch_df(conn, q, {"email": agent_email})
+
+    # Coerced once per cache fill rather than on every render of the cached frame.
+    num_cols = ["last_month_revenue", "last_month_orders", "mtd_revenue", "mtd_orders"]
+    df[num_cols] = df[num_cols].apply(pd.to_numeric, errors="coerce").fillna(0)
+    return df
 
 
 # -----------------------------------------------------------------------------
@@ -481,10 +667,10 @@ def render_feedback_dialog():
         st.session_state.pending_status_payload = None
         st.rerun()
 
-    if hasattr(st, "dialog"):
+    if _HAS_DIALOG:
         with st.dialog("Fill Feedback form"):
             st.write("Please fill feedback for the call.")
-            if hasattr(st, "link_button"):
+            if _HAS_LINK_BUTTON:
                 if st.link_button("Open feedback form", FEEDBACK_FORM_URL):
                     _close()
             else:
@@ -494,7 +680,7 @@ def render_feedback_dialog():
     else:
         with st.container(border=True):
             st.subheader("Fill Feedback form")
-            if hasattr(st, "link_button"):
+            if _HAS_LINK_BUTTON:
                 if st.link_button("Open feedback form", FEEDBACK_FORM_URL):
                     _close()
             else:
@@ -511,23 +697,26 @@ def render_login():
     st.markdown("## Select User")
     st.caption("Choose your name to log in")
 
+    if st.button("↻ Refresh users"):
+        fetch_central_farmers.clear()
+
     farmers_df = fetch_central_farmers()
     if farmers_df.empty:
         st.error("No central_farmers configured in app_user.")
         return
 
-    name_map = {r["name"]: r for _, r in farmers_df.iterrows()}
+    # name -> {id, email, role}; one to_dict pass, last row wins on duplicate names.
+    name_map = farmers_df.drop_duplicates("name", keep="last").set_index("name").to_dict(orient="index")
     selected_name = st.selectbox("User", list(name_map.keys()))
+    r = name_map.get(selected_name)
 
-    if selected_name:
-        r = name_map[selected_name]
+    if r:
         st.write(f"Email: `{r['email']}` | Role: `{r['role']}`")
 
-    if st.button("Log In"):
-        r = name_map[selected_name]
+    if st.button("Log In") and r:
         st.session_state.current_user = {
             "id": r["id"],
-            "name": r["name"],
+            "name": selected_name,
             "email": r["email"],
             "role": r["role"],
         }
@@ -540,62 +729,19 @@ def render_login():
 # KANBAN CARD (FIXED: all 'row' usage is inside this function)
 # -----------------------------------------------------------------------------
 
-def _fmt_dt(val) -> str:
-    if val is None or (isinstance(val, float) and pd.isna(val)):
-        return "-"
-    try:
-        return str(val)[:19].replace("T", " ")
-    except Exception:
-        return str(val)
+# The only fields render_account_card reads; the card loop iterates just these.
+CARD_COLS = ["work_item_id", "status", "card_html"]
 
 
 def render_account_card(row):
-    latest_follow_up_date = row.get("latest_follow_up_date")
-    bucket_key = row.get("priority_bucket_key", "regular_activation")
-    bucket_label = PRIORITY_LABEL_BY_KEY.get(bucket_key, bucket_key)
-    bucket_color = PRIORITY_COLOR_BY_KEY.get(bucket_key, "#616161")
-
-    ext_id = str(row.get("external_partner_id") or "").strip()
-    oms_url = f"https://oms.orangehealth.in/partner/{ext_id}" if ext_id else None
-
-    created_at = _fmt_dt(row.get("created_at"))
-    refreshed_at = _fmt_dt(row.get("refreshed_at"))
-
-    # Card UI: only name, external id, bucket, OMS link, first added, last refresh
-    st.markdown(
-        f"""
-        <div style="border-left: 6px solid {bucket_color}; padding-left: 10px;">
-          <div style="font-size: 16px; font-weight: 700;">{row.get('partner_name','-')}</div>
-          <div style="margin-top:2px;">
-            <span style="font-weight:600;">External ID:</span>
-            <code>{ext_id or '-'}</code>
-          </div>
-          <div style="margin-top:2px;">
-            <span style="font-weight:600;">Category:</span>
-            <span style="color:{bucket_color}; font-weight:800;">{bucket_label}</span>
-          </div>
-        </div>
-        """.strip(),
-        unsafe_allow_html=True,
-    )
-    if row["status"] == "follow_up" and latest_follow_up_date:
-        st.markdown(
-            f"<div style='margin-top:6px; font-size:13px;'>"
-            f"🗓️ <b>Follow-up on:</b> "
-            f"<code>{latest_follow_up_date}</code>"
-            f"</div>",
-            unsafe_allow_html=True,
-        )
-
-    if oms_url:
-        st.markdown(f"[OMS Link: {oms_url}]({oms_url})")
-
-    st.markdown(
-        f"<div style='font-size:12px; opacity:0.8;'>First Added: <code>{created_at}</code> · Last Refresh: <code>{refreshed_at}</code></div>",
-        unsafe_allow_html=True,
-    )
-    wid = str(row["work_item_id"])
-    current_status = row["status"]
+    # card_html is pre-rendered for the whole board in fetch_work_items_for_agent.
+    st.markdown(row.card_html, unsafe_allow_html=True)
+
+    # Deliberately not in an st.form: every move opens the feedback dialog for that one
+    # card, and forms don't allow on_change callbacks. The rerun it triggers is already
+    # scoped to the _render_board_body fragment and served from the cached fetch.
+    wid = str(row.work_item_id)
+    current_status = row.status
     new_status = st.selectbox(
         "Move to...",
         STATUS_KEYS,
@@ -621,12 +767,12 @@ def render_board():
 
     # Ensure required DB columns exist
     try:
-        ensure_workitem_columns()
-        ensure_partner_type_tag_column()
+        _schema_ready()
     except Exception as e:
         st.error("Could not ensure required columns exist on DB.")
         st.caption(f"DB message: {e}")
         return
+    _board_indexes_ready()
 
 
     c1, c2 = st.columns([1, 2], vertical_alignment="center")
@@ -647,22 +793,30 @@ def render_board():
             "Priority is recalculated automatically."
         )
 
+    _render_board_body(user["id"])
 
-    df = fetch_work_items_for_agent(user["id"])
-    if df.empty:
+
+@st.fragment
+def _render_board_body(agent_id: str):
+    """
+    Filters + kanban columns. Widget changes in here rerun only this fragment,
+    not the whole script. The fetch stays inside so a saved status change shows up
+    on the fragment rerun; it's cached, so filter edits never hit the DB.
+    """
+    # The ID search runs in SQL; its widget is drawn further down, so read last run's value.
+    id_search = (st.session_state.get("filter_external_partner_id") or "").strip()
+    ext_id_filter = f"%{_escape_like(id_search)}%" if id_search else None
+    df = fetch_work_items_for_agent(agent_id, ext_id_filter, date.today())
+    if df.empty and not id_search:
         st.info("No work items found for today. Try Refresh.")
         return
 
-    df = df.copy()
-    df["work_item_id"] = df["work_item_id"].astype(str)
-    df["partner_id"] = df["partner_id"].astype(str)
 
-
-    # Used by status dropdown callback
-    st.session_state["_row_lookup"] = {
-        str(r["work_item_id"]): r.to_dict()
-        for _, r in df.iterrows()
-    }
+    # Used by status dropdown callback, which only reads these fields. Built in one
+    # to_dict pass over just those columns instead of boxing every cell of every row.
+    st.session_state["_row_lookup"] = (
+        df.set_index("work_item_id")[ROW_LOOKUP_COLS].to_dict(orient="index")
+    )
 
 
     # -----------------------------
@@ -691,45 +845,47 @@ def render_board():
         )
 
     with f3:
-        external_id_search = st.text_input(
+        st.text_input(
             "External Partner ID (search)",
             value="",
             placeholder="e.g. 3579 (supports partial match)",
             key="filter_external_partner_id",
         )
 
-    filtered_df = df.copy()
+    # Combine the active filters into one mask; with no filters df is used as-is (no copy).
+    mask = None
 
     if selected_buckets:
-        filtered_df = filtered_df[filtered_df["priority_bucket_key"].isin(selected_buckets)]
+        mask = df["priority_bucket_key"].isin(selected_buckets)
 
     if partner_type_tag_filter:
         # partner_type_tag can be null for older partners; those will be excluded unless you select none
-        filtered_df = filtered_df[filtered_df["partner_type_tag"].isin(partner_type_tag_filter)]
+        tag_mask = df["partner_type_tag"].isin(partner_type_tag_filter)
+        mask = tag_mask if mask is None else mask & tag_mask
 
-    if external_id_search and external_id_search.strip():
-        s = external_id_search.strip().lower()
-        filtered_df = filtered_df[
-            filtered_df["external_partner_id"].astype(str).str.lower().str.contains(s, na=False)
-        ]
+    filtered_df = df if mask is None else df.loc[mask]
 
     st.caption(f"Showing **{len(filtered_df)}** / {len(df)} accounts after filters.")
 
-    status_counts = {s: int((filtered_df["status"] == s).sum()) for s in STATUS_KEYS}
+    # One stable sort by column position; each column is then a contiguous slice found
+    # with searchsorted, and rows keep their priority order within the column.
+    codes = pd.Categorical(filtered_df["status"], categories=STATUS_KEYS).codes
+    order = np.argsort(codes, kind="stable")
+    by_status = filtered_df.iloc[order]
+    bounds = np.searchsorted(codes[order], np.arange(len(STATUS_KEYS) + 1))
     render_status_update_dialog()
     cols = st.columns(len(STATUS_KEYS))
-    for col, status in zip(cols, STATUS_KEYS):
+    for i, (col, status) in enumerate(zip(cols, STATUS_KEYS)):
         label = STATUS_LABELS.get(status, status)
+        subset = by_status.iloc[bounds[i]:bounds[i + 1]]
         with col:
-            st.markdown(f"#### {label} ({status_counts.get(status, 0)})")
-            subset = filtered_df[filtered_df["status"] == status]
+            st.markdown(f"#### {label} ({len(subset)})")
             if subset.empty:
                 st.caption("_No accounts in this column_")
             else:
-                for _, r in subset.iterrows():
+                for r in subset[CARD_COLS].itertuples(index=False):
                     with st.container(border=True):
                         render_account_card(r)
-    ensure_activity_log_table()
     
 
 # Feedback Popup
@@ -744,13 +900,15 @@ def render_status_update_dialog():
         st.session_state.pending_status_payload = None
         return
 
+    # Both buttons use these as on_click callbacks; the callback's own rerun (scoped
+    # to the board fragment) redraws the board, so no st.rerun() here.
     def _close():
         st.session_state.open_status_dialog = False
         st.session_state.pending_status_payload = None
-        st.rerun()
+        st.session_state.status_save_warning = None
 
     def _save(call_status, sentiment, concern, next_action, follow_up_date):
-        persist_status_change({
+        saved = persist_status_change({
             **payload,
             "call_status": call_status,
             "doctor_sentiment": sentiment,
@@ -758,7 +916,19 @@ def render_status_update_dialog():
             "next_suggested_action": next_action,
             "follow_up_date": follow_up_date,
         })
-        _close()
+        if saved:
+            _close()
+            return
+
+        # Nothing matched: the board was stale (e.g. saved from another tab) and the item
+        # already has this status. Keep the dialog, and the typed notes, open and say so;
+        # drop the cached board so the one behind it shows the current status.
+        fetch_work_items_for_agent.clear()
+        label = STATUS_LABELS.get(payload["status"], payload["status"])
+        st.session_state.status_save_warning = (
+            f"Not saved: this account is already '{label}' (probably changed in another tab). "
+            "Copy your notes if needed, then Cancel."
+        )
 
     # ----------------------------
     # UI START (orange container)
@@ -780,6 +950,9 @@ def render_status_update_dialog():
 
         st.subheader("📋 Call Feedback")
 
+        if st.session_state.get("status_save_warning"):
+            st.warning(st.session_state.status_save_warning)
+
         st.text_input("Partner ID", payload["external_partner_id"], disabled=True)
         st.text_input("Doctor Name", payload["partner_name"], disabled=True)
         st.text_input("Agent Name", payload["agent_name"], disabled=True)
@@ -880,85 +1053,543 @@ def render_status_update_dialog():
             )
 
 
-def persist_status_change(payload):
-    with get_connection() as conn:
-        conn.execute(
-            text("""
-            UPDATE work_item
-            SET status = :status,
-                updated_at = NOW()
-            WHERE id = :work_item_id
-            """),
-            payload,
-        )
+# Built once at import, like the upload statements: it runs on every status move.
+STATUS_CHANGE_SQL = text(
+    """
+    WITH u AS (
+        UPDATE work_item
+        SET status = :status,
+            updated_at = NOW()
+        WHERE id = :work_item_id
+          AND status IS DISTINCT FROM :status
+        RETURNING id, partner_id
+    )
+    INSERT INTO work_item_activity_log (
+        work_item_id,
+        partner_id,
+        external_partner_id,
+        partner_name,
+        agent_id,
+        agent_name,
+        status,
+        doctor_sentiment,
+        primary_concern,
+        next_suggested_action,
+        call_status,
+        follow_up_date
+    )
+    SELECT
+        u.id,
+        u.partner_id,
+        :external_partner_id,
+        :partner_name,
+        :agent_id,
+        :agent_name,
+        :status,
+        :doctor_sentiment,
+        :primary_concern,
+        :next_suggested_action,
+        :call_status,
+        :follow_up_date
+    FROM u
+    """
+)
 
-        conn.execute(
-            text("""
-            INSERT INTO work_item_activity_log (
-                work_item_id,
-                partner_id,
-                external_partner_id,
-                partner_name,
-                agent_id,
-                agent_name,
-                status,
-                doctor_sentiment,
-                primary_concern,
-                next_suggested_action,
-                call_status,
-                follow_up_date
-            )
-            VALUES (
-                :work_item_id,
-                :partner_id,
-                :external_partner_id,
-                :partner_name,
-                :agent_id,
-                :agent_name,
-                :status,
-                :doctor_sentiment,
-                :primary_concern,
-                :next_suggested_action,
-                :call_status,
-                :follow_up_date
 
-            )
-            """),
-            payload,
-        )
-        conn.commit()
+def persist_status_change(payload) -> bool:
+    """
+    Status update + activity log in one statement (one round trip). The UPDATE only
+    matches when the status actually changes, and the log row is selected from its
+    RETURNING, so a repeated save (rerun race, double click) writes nothing.
+    Returns whether anything changed.
+    """
+    with get_transaction() as conn:
+        res = conn.execute(STATUS_CHANGE_SQL, payload)
+        changed = bool(res.rowcount)
+
+    if changed:
+        fetch_work_items_for_agent.clear()
+    return changed
 
 # -----------------------------------------------------------------------------
 # UPLOAD DATA
 # -----------------------------------------------------------------------------
 
-def _normalize_partner_type(val: str) -> str:
-    if val is None:
-        return None
-    s = str(val).strip().lower()
-    if s in {"at_home", "athome", "at-home", "home", "at home"}:
-        return "At-Home"
-    if s in {"in_clinic", "inclinic", "in-clinic", "clinic", "in clinic"}:
-        return "In Clinic"
-    if s in {"eclinic", "e-clinic"}:
-        return "eClinic"
-    return str(val).strip()
-
-
-def _normalize_partner_type_tag(val):
-    if val is None or (isinstance(val, float) and pd.isna(val)):
-        return None
-    s = str(val).strip().lower()
-    if s in {"portfolio", "p"}:
-        return "Portfolio"
-    if s in {"longtail", "long tail", "lt", "l"}:
-        return "Longtail"
-    return None
+METRICS_PARTNER_COLS = [
+    "external_partner_id",
+    "partner_name",
+    "city",
+    "partner_bd",
+    "bd_cat",
+    "partner_type",
+    "price_list",
+    "partner_type_tag",
+]
+
+METRICS_NUMERIC_COLS = ["orders", "gmv", "net_revenue", "rev_per_gmv", "channel_share", "active_days"]
+
+METRICS_UPLOAD_COLS = METRICS_PARTNER_COLS + METRICS_NUMERIC_COLS
+
+PARTNER_MAP_COLS = [
+    "external_partner_id",
+    "partner_name",
+    "city",
+    "phone",
+    "partner_type",
+    "wallet_amount",
+    "partner_type_tag",
+]
+
+
+PARTNER_TYPE_MAP = {
+    **dict.fromkeys(["at_home", "athome", "at-home", "home", "at home"], "At-Home"),
+    **dict.fromkeys(["in_clinic", "inclinic", "in-clinic", "clinic", "in clinic"], "In Clinic"),
+    **dict.fromkeys(["eclinic", "e-clinic"], "eClinic"),
+}
+
+PARTNER_TYPE_TAG_MAP = {
+    **dict.fromkeys(["portfolio", "p"], "Portfolio"),
+    **dict.fromkeys(["longtail", "long tail", "lt", "l"], "Longtail"),
+}
+
+
+def _sql_case_map(col: str, mapping: dict, default: str) -> str:
+    """CASE lower(btrim(col)) WHEN <spelling> THEN <label> ... ELSE default END."""
+    whens = " ".join(f"WHEN '{k}' THEN '{v}'" for k, v in mapping.items())
+    return f"CASE lower(btrim({col})) {whens} ELSE {default} END"
+
+
+# Uploads stage partner_type / partner_type_tag as given and the merge normalizes them:
+# known spellings -> canonical label; an unknown type is kept (stripped), an unknown tag
+# is NULL so the partner's existing tag is left alone.
+PARTNER_TYPE_SQL = _sql_case_map("partner_type", PARTNER_TYPE_MAP, "btrim(partner_type)")
+PARTNER_TYPE_TAG_SQL = _sql_case_map("partner_type_tag", PARTNER_TYPE_TAG_MAP, "NULL")
+
+
+# Uploads COPY rows into a temp table typed like the real columns, then merge with
+# set-based statements: no per-row parse/plan on the server. Built once at import.
+# Temp tables skip WAL like an UNLOGGED table but are private to the session, so
+# concurrent uploads never share a staging table, and COPY beats to_sql(method="multi").
+METRICS_STAGE_SQL = text(
+    """
+    CREATE TEMP TABLE IF NOT EXISTS tmp_metrics_upload
+    ON COMMIT DELETE ROWS AS
+    SELECT
+        external_partner_id,
+        partner_name,
+        city,
+        partner_bd,
+        bd_cat,
+        partner_type,
+        price_list,
+        partner_type_tag,
+        NULL::numeric AS orders,
+        NULL::numeric AS gmv,
+        NULL::numeric AS net_revenue,
+        NULL::numeric AS rev_per_gmv,
+        NULL::numeric AS channel_share,
+        NULL::numeric AS active_days
+    FROM partner
+    WITH NO DATA;
+
+    TRUNCATE tmp_metrics_upload;
+    """
+)
+
+# Partner upsert and metric upsert in one statement: the CTE's RETURNING gives the
+# partner ids (inserted or updated), so there's no second round-trip to look them up.
+# Both conflict updates only fire when a value actually changes, so re-uploading the
+# same sheet writes (and WAL-logs) nothing and rowcount counts real changes.
+METRICS_UPSERT_SQL = text(
+    f"""
+    WITH up AS (
+        INSERT INTO partner (
+            external_partner_id,
+            partner_name,
+            city,
+            partner_bd,
+            bd_cat,
+            partner_type,
+            price_list,
+            partner_type_tag,
+            updated_at
+        )
+        SELECT
+            external_partner_id,
+            partner_name,
+            city,
+            partner_bd,
+            bd_cat,
+            {PARTNER_TYPE_SQL},
+            price_list,
+            {PARTNER_TYPE_TAG_SQL},
+            NOW()
+        FROM tmp_metrics_upload
+        ON CONFLICT (external_partner_id) DO UPDATE SET
+            partner_name      = EXCLUDED.partner_name,
+            city              = EXCLUDED.city,
+            partner_bd        = EXCLUDED.partner_bd,
+            bd_cat            = EXCLUDED.bd_cat,
+            partner_type      = EXCLUDED.partner_type,
+            price_list        = EXCLUDED.price_list,
+            partner_type_tag  = COALESCE(EXCLUDED.partner_type_tag, partner.partner_type_tag),
+            updated_at        = NOW()
+        WHERE (
+            partner.partner_name, partner.city, partner.partner_bd, partner.bd_cat,
+            partner.partner_type, partner.price_list, partner.partner_type_tag
+        ) IS DISTINCT FROM (
+            EXCLUDED.partner_name, EXCLUDED.city, EXCLUDED.partner_bd, EXCLUDED.bd_cat,
+            EXCLUDED.partner_type, EXCLUDED.price_list,
+            COALESCE(EXCLUDED.partner_type_tag, partner.partner_type_tag)
+        )
+        RETURNING id, external_partner_id
+    ),
+    -- Unchanged partners aren't updated, so aren't RETURNed; the statement's snapshot
+    -- of partner (before the upsert) still has their ids.
+    ids AS (
+        SELECT id, external_partner_id FROM up
+        UNION
+        SELECT p.id, p.external_partner_id
+        FROM partner p
+        JOIN tmp_metrics_upload t ON t.external_partner_id = p.external_partner_id
+    )
+    INSERT INTO partner_monthly_metrics (
+        partner_id,
+        month_date,
+        orders,
+        gmv,
+        net_revenue,
+        rev_per_gmv,
+        channel_share,
+        active_days,
+        updated_at
+    )
+    SELECT
+        ids.id,
+        :month_date,
+        COALESCE(t.orders, 0),
+        COALESCE(t.gmv, 0),
+        COALESCE(t.net_revenue, 0),
+        COALESCE(t.rev_per_gmv, 0),
+        COALESCE(t.channel_share, 0),
+        COALESCE(t.active_days, 0),
+        NOW()
+    FROM tmp_metrics_upload t
+    JOIN ids ON ids.external_partner_id = t.external_partner_id
+    ON CONFLICT (partner_id, month_date) DO UPDATE SET
+        orders        = EXCLUDED.orders,
+        gmv           = EXCLUDED.gmv,
+        net_revenue   = EXCLUDED.net_revenue,
+        rev_per_gmv   = EXCLUDED.rev_per_gmv,
+        channel_share = EXCLUDED.channel_share,
+        active_days   = EXCLUDED.active_days,
+        updated_at    = NOW()
+    WHERE (
+        partner_monthly_metrics.orders, partner_monthly_metrics.gmv,
+        partner_monthly_metrics.net_revenue, partner_monthly_metrics.rev_per_gmv,
+        partner_monthly_metrics.channel_share, partner_monthly_metrics.active_days
+    ) IS DISTINCT FROM (
+        EXCLUDED.orders, EXCLUDED.gmv, EXCLUDED.net_revenue,
+        EXCLUDED.rev_per_gmv, EXCLUDED.channel_share, EXCLUDED.active_days
+    );
+    """
+)
+
+# Partner-map upload: same shape, partner upsert + mapping insert in one statement.
+PARTNER_STAGE_SQL = text(
+    """
+    CREATE TEMP TABLE IF NOT EXISTS tmp_partner_upload
+    ON COMMIT DELETE ROWS AS
+    SELECT
+        external_partner_id,
+        partner_name,
+        city,
+        phone,
+        partner_type,
+        wallet_amount,
+        partner_type_tag
+    FROM partner
+    WITH NO DATA;
+
+    TRUNCATE tmp_partner_upload;
+    """
+)
+
+PARTNER_UPSERT_MAP_SQL = text(
+    f"""
+    WITH up AS (
+        INSERT INTO partner (
+          external_partner_id,
+          partner_name,
+          city,
+          phone,
+          partner_type,
+          wallet_amount,
+          partner_type_tag,
+          updated_at
+        )
+        SELECT
+          external_partner_id,
+          partner_name,
+          city,
+          phone,
+          {PARTNER_TYPE_SQL},
+          COALESCE(wallet_amount, 0),
+          {PARTNER_TYPE_TAG_SQL},
+          NOW()
+        FROM tmp_partner_upload
+        ON CONFLICT (external_partner_id) DO UPDATE SET
+          partner_name      = EXCLUDED.partner_name,
+          city              = EXCLUDED.city,
+          phone             = EXCLUDED.phone,
+          partner_type      = EXCLUDED.partner_type,
+          wallet_amount     = EXCLUDED.wallet_amount,
+          partner_type_tag  = COALESCE(EXCLUDED.partner_type_tag, partner.partner_type_tag),
+          updated_at        = NOW()
+        WHERE (
+          partner.partner_name, partner.city, partner.phone,
+          partner.partner_type, partner.wallet_amount, partner.partner_type_tag
+        ) IS DISTINCT FROM (
+          EXCLUDED.partner_name, EXCLUDED.city, EXCLUDED.phone,
+          EXCLUDED.partner_type, EXCLUDED.wallet_amount,
+          COALESCE(EXCLUDED.partner_type_tag, partner.partner_type_tag)
+        )
+        RETURNING id
+    ),
+    -- Unchanged partners aren't RETURNed; take their ids from the pre-upsert snapshot.
+    ids AS (
+        SELECT id FROM up
+        UNION
+        SELECT p.id
+        FROM partner p
+        JOIN tmp_partner_upload t ON t.external_partner_id = p.external_partner_id
+    )
+    INSERT INTO partner_agent_map (partner_id, agent_id)
+    SELECT id, :agent_id
+    FROM ids
+    ON CONFLICT DO NOTHING;
+    """
+)
+
+
+def _copy_df(conn, table: str, df: pd.DataFrame, cols: list) -> None:
+    """
+    Stream df[cols] into `table` with COPY ... FROM STDIN (CSV) on the caller's
+    transaction. Missing columns / NaN go in as NULL.
+
+    Streamlit already runs each session's script on its own thread with its own pooled
+    connection, so concurrent uploads from different agents COPY in parallel; there's
+    no need for a separate asyncio/asyncpg ingest path.
+    """
+    buf = io.StringIO()
+    df.reindex(columns=cols).to_csv(buf, index=False, header=False)
+    buf.seek(0)
+
+    cur = conn.connection.cursor()
+    try:
+        # The buffer is already in memory; read it in 1 MiB pieces rather than
+        # copy_expert's default 8 KiB, so a 5k-row chunk is a handful of sends.
+        cur.copy_expert(f"COPY {table} ({', '.join(cols)}) FROM STDIN WITH (FORMAT csv)", buf, size=1 << 20)
+    finally:
+        cur.close()
+
+
+# Each chunk is one COPY + one merge statement, and a bad row is isolated by bisection,
+# so chunks can be large: a typical monthly sheet goes up in a single chunk.
+UPLOAD_CHUNK_ROWS = 5000
+ERROR_ROW_COLUMNS = ["row_index", "external_partner_id", "error"]
+
+# Errors caused by the rows themselves, the only ones worth bisecting. COPY goes through
+# the raw psycopg2 cursor, so its errors arrive unwrapped.
+ROW_DATA_ERRORS = (DataError, IntegrityError, psycopg2.DataError, psycopg2.IntegrityError)
+
+
+def _save_rows(conn, rows: pd.DataFrame, save_fn, error_rows: list) -> int:
+    """
+    save_fn(conn, rows) inside a SAVEPOINT. On a row-data error (bad value, constraint
+    violation), roll back and split the rows in half until the bad ones are isolated,
+    so a chunk with k bad rows costs ~k*log2(n) retries instead of n single-row
+    statements. Anything else (SQL error, timeout, lost connection) would fail every
+    half the same way, so it propagates and the caller's transaction rolls back.
+    """
+    try:
+        with conn.begin_nested():
+            return save_fn(conn, rows)
+    except ROW_DATA_ERRORS as e:
+        if len(rows) == 1:
+            error_rows.append((int(rows.index[0]), rows["external_partner_id"].iloc[0], str(e)))
+            return 0
+
+    mid = len(rows) // 2
+    return (
+        _save_rows(conn, rows.iloc[:mid], save_fn, error_rows)
+        + _save_rows(conn, rows.iloc[mid:], save_fn, error_rows)
+    )
+
+
+def _save_in_chunks(conn, df: pd.DataFrame, save_fn, error_rows: list) -> int:
+    """
+    Call save_fn(conn, chunk) -> rows saved for each UPLOAD_CHUNK_ROWS slice of df.
+    error_rows only names the rows that actually fail and the rest still get saved.
+    Failures are appended as (row_index, external_partner_id, error) tuples.
+    """
+    saved = 0
+    for start in range(0, len(df), UPLOAD_CHUNK_ROWS):
+        saved += _save_rows(conn, df.iloc[start:start + UPLOAD_CHUNK_ROWS], save_fn, error_rows)
+    return saved
+
+
+@st.cache_data(show_spinner=False, max_entries=4)
+def _parse_csv(data: bytes, **read_kwargs) -> pd.DataFrame:
+    """
+    read_csv keyed on the uploaded bytes: widget clicks rerun the script, but the same
+    file is only parsed once. A new upload has new bytes and misses the cache.
+    """
+    return pd.read_csv(io.BytesIO(data), **read_kwargs)
+
+
+def _upload_fingerprint(data: bytes, *scope) -> str:
+    """Content hash of an upload plus whatever it was applied to (e.g. the agent id)."""
+    h = hashlib.blake2b(data, digest_size=16)
+    h.update(repr(scope).encode())
+    return h.hexdigest()
+
+
+def _clean_external_id(col: pd.Series) -> pd.Series:
+    """Stripped external_partner_id as str in one vectorized pass; blank/'nan'/missing -> None."""
+    ext = col.astype("string").str.strip()
+    bad = ext.isna() | ext.eq("") | ext.str.lower().eq("nan")
+    return ext.astype(object).where(~bad, None)
+
+
+def _csv_key(col) -> str:
+    """Header as looked up in the *_CSV_RENAME maps: trimmed, lowercased, spaces -> '_'."""
+    return str(col).strip().lower().replace(" ", "_")
+
+
+def _rename_csv_columns(df: pd.DataFrame, aliases: dict) -> pd.DataFrame:
+    """
+    Rename known headers whatever their case/spacing; unknown headers are left as-is.
+    Headers that land on the same name ("Partner Tag" + "Partner Segment", "Partner ID"
+    + "PARTNER_ID") are collapsed into one column holding each row's first non-null value.
+    """
+    df = df.rename(columns=lambda c: aliases.get(_csv_key(c), c))
+    if not df.columns.has_duplicates:
+        return df
+
+    dup_mask = df.columns.duplicated()
+    merged = {c: df.loc[:, c].bfill(axis=1).iloc[:, 0] for c in df.columns[dup_mask].unique()}
+    df = df.loc[:, ~dup_mask].copy()
+    for col, values in merged.items():
+        df[col] = values
+    return df
+
+
+# Keys are _csv_key() forms, so "Partner ID", "PARTNER_ID" and " partner id " all match.
+METRICS_CSV_RENAME = {
+    # Partner identifiers
+    "partner_id": "external_partner_id",
+    "partner_name": "partner_name",
+    "partner_city": "city",
+
+    # Partner metadata
+    "partner_bd": "partner_bd",
+    "bd_cat": "bd_cat",
+    "partner_type": "partner_type",
+    "price_list": "price_list",
+    "partner_tag": "partner_type_tag",
+    "active_days": "active_days",
+
+    # Monthly metrics
+    "#orders": "orders",
+    "gmv": "gmv",
+    "net_revenue": "net_revenue",
+    "rev/gmv": "rev_per_gmv",
+    "channel_share": "channel_share",
+}
+
+
+def _prepare_metrics_chunk(raw: pd.DataFrame) -> pd.DataFrame:
+    """Rename + clean one chunk of the monthly metrics CSV (types are normalized in SQL)."""
+    df = _rename_csv_columns(raw, METRICS_CSV_RENAME)
+    df["external_partner_id"] = _clean_external_id(df["external_partner_id"])
+
+    # Project onto exactly the staged columns (absent ones come in as NaN), then coerce
+    # every metric in one frame-level pass, so each chunk reaches COPY with the same
+    # shape and float64 metrics, with missing metrics as 0.
+    df = df.reindex(columns=METRICS_UPLOAD_COLS)
+    df[METRICS_NUMERIC_COLS] = (
+        df[METRICS_NUMERIC_COLS].apply(pd.to_numeric, errors="coerce").fillna(0).astype("float64")
+    )
+
+    return df
+
+
+PARTNER_CSV_RENAME = {
+    "partner_id": "external_partner_id",
+    "partner_name": "partner_name",
+    "phone_num": "phone",
+    "partner_type": "partner_type",
+    "wallet_amount": "wallet_amount",
+    "city": "city",
+    "type": "partner_type_tag",
+    "partner_segment": "partner_type_tag",
+    "partner_tag": "partner_type_tag",
+}
+
+CSV_CHUNK_ROWS = 10_000
+
+
+def _advance_upload_progress(bar, uploaded_file) -> None:
+    """Move bar to how far read_csv has consumed the upload (bytes read / file size)."""
+    bar.progress(min(uploaded_file.tell() / max(uploaded_file.size, 1), 1.0))
+
+
+def _count_new_ids(batch: pd.DataFrame, seen: set) -> int:
+    """
+    How many of a chunk's (already de-duplicated) Partner IDs no earlier chunk had;
+    adds them to seen. Keeps upload counts file-wide rather than per chunk.
+    """
+    ids = batch["external_partner_id"]
+    new = int((~ids.isin(seen)).sum())
+    seen.update(ids)
+    return new
+
+
+def _prepare_partner_chunk(raw: pd.DataFrame) -> pd.DataFrame:
+    """Rename + clean one chunk of the partner-map CSV (types are normalized in SQL)."""
+    p_df = _rename_csv_columns(raw, PARTNER_CSV_RENAME)
+
+    p_df["external_partner_id"] = _clean_external_id(p_df["external_partner_id"])
+
+    # Only the staged columns are kept; absent ones come in as NaN (NULL on COPY).
+    p_df = p_df.reindex(columns=PARTNER_MAP_COLS)
+    p_df["wallet_amount"] = pd.to_numeric(p_df["wallet_amount"], errors="coerce").fillna(0)
+
+    return p_df
 
 
 def render_upload_tab(manager_mode=False):
     st.markdown("### Upload Data")
 
+    # Both uploads write partner.partner_type_tag; cached, so this is a no-op after the
+    # first call in the process.
+    try:
+        _partner_tag_ready()
+    except Exception as e:
+        st.error("Could not ensure required columns exist on DB.")
+        st.caption(f"DB message: {e}")
+        return
+
+    _render_metrics_upload()
+    st.divider()
+    _render_partner_map_upload(manager_mode)
+
+
+# Each upload section is a fragment: its widgets (month picker, file uploader, agent
+# select, buttons) rerun only that section, not the whole tab and app around it.
+@st.fragment
+def _render_metrics_upload():
     # -------------------------------
     # A) Monthly metrics upload
     # -------------------------------
@@ -983,190 +1614,99 @@ def render_upload_tab(manager_mode=False):
     uploaded_file = st.file_uploader("Choose CSV file (monthly metrics)", type=["csv"], key="monthly_metrics_csv")
     if uploaded_file is not None:
         try:
-            raw_df = pd.read_csv(uploaded_file)
+            # All text: the ID header can be spelled several ways, and a blank cell would
+            # otherwise make it float ("123.0"). Metrics are coerced to numbers on save.
+            raw_df = _parse_csv(uploaded_file.getvalue(), nrows=50, dtype=str)
         except Exception as e:
             st.error(f"Error reading CSV: {e}")
             raw_df = None
 
         if raw_df is not None:
             st.write("Preview of uploaded data:")
-            st.dataframe(raw_df.head(50), use_container_width=True)
-
-            df = raw_df.rename(
-                columns={
-                    # Partner identifiers
-                    "PARTNER_ID": "external_partner_id",
-                    "PARTNER_NAME": "partner_name",
-                    "Partner City": "city",
-
-                    # Partner metadata
-                    "PARTNER_BD": "partner_bd",
-                    "BD_CAT": "bd_cat",
-                    "PARTNER_TYPE": "partner_type",
-                    "PRICE_LIST": "price_list",
-                    "PARTNER_TAG": "partner_type_tag",
-                    "ACTIVE_DAYS": "active_days",
-
-                    # Monthly metrics
-                    "#Orders": "orders",
-                    "GMV": "gmv",
-                    "NET_REVENUE": "net_revenue",
-                    "Rev/GMV": "rev_per_gmv",
-                    "CHANNEL_SHARE": "channel_share",
-                }
-            )
+            st.dataframe(raw_df, use_container_width=True)
 
-
-            if "external_partner_id" not in df.columns:
+            if "external_partner_id" not in _rename_csv_columns(raw_df, METRICS_CSV_RENAME).columns:
                 st.error("Could not find `Partner ID` column to map to external_partner_id.")
-            else:
-                numeric_cols = ["orders", "gmv", "net_revenue", "rev_per_gmv", "channel_share", "active_days"]
-                for c in numeric_cols:
-                    if c in df.columns:
-                        df[c] = pd.to_numeric(df[c], errors="coerce").fillna(0)
-
-                if "partner_type_tag" in df.columns:
-                    df["partner_type_tag"] = df["partner_type_tag"].apply(_normalize_partner_type_tag)
-
-                if st.button("Upload & Save Monthly Metrics", key="btn_upload_metrics"):
-                    partner_upserts = 0
-                    metric_upserts = 0
-                    error_rows = []
-
-                    with get_connection() as conn:
-                        for idx, row in df.iterrows():
-                            external_id = str(row.get("external_partner_id")).strip()
-                            if not external_id or external_id.lower() == "nan":
-                                continue
-
-                            partner_params = {
-                                "external_partner_id": external_id,
-                                "partner_name": row.get("partner_name"),
-                                "city": row.get("city"),
-                                "partner_bd": row.get("partner_bd"),
-                                "bd_cat": row.get("bd_cat"),
-                                "partner_type": row.get("partner_type"),
-                                "price_list": row.get("price_list"),
-                                "partner_type_tag": row.get("partner_type_tag"),
-                            }
-
-                            try:
-                                result = conn.execute(
-                                    text(
-                                        """
-                                        INSERT INTO partner (
-                                            external_partner_id,
-                                            partner_name,
-                                            city,
-                                            partner_bd,
-                                            bd_cat,
-                                            partner_type,
-                                            price_list,
-                                            partner_type_tag,
-                                            updated_at
-                                        )
-                                        VALUES (
-                                            :external_partner_id,
-                                            :partner_name,
-                                            :city,
-                                            :partner_bd,
-                                            :bd_cat,
-                                            :partner_type,
-                                            :price_list,
-                                            :partner_type_tag,
-                                            NOW()
-                                        )
-                                        ON CONFLICT (external_partner_id) DO UPDATE SET
-                                            partner_name      = EXCLUDED.partner_name,
-                                            city              = EXCLUDED.city,
-                                            partner_bd        = EXCLUDED.partner_bd,
-                                            bd_cat            = EXCLUDED.bd_cat,
-                                            partner_type      = EXCLUDED.partner_type,
-                                            price_list        = EXCLUDED.price_list,
-                                            partner_type_tag  = COALESCE(EXCLUDED.partner_type_tag, partner.partner_type_tag),
-                                            updated_at        = NOW()
-                                        RETURNING id;
-                                        """
-                                    ),
-                                    partner_params,
-                                )
-                                partner_id = result.scalar()
-                                partner_upserts += 1
-
-                                metric_params = {
-                                    "partner_id": partner_id,
-                                    "month_date": month_date,
-                                    "orders": row.get("orders", 0),
-                                    "gmv": row.get("gmv", 0),
-                                    "net_revenue": row.get("net_revenue", 0),
-                                    "rev_per_gmv": row.get("rev_per_gmv", 0),
-                                    "channel_share": row.get("channel_share", 0),
-                                    "active_days": row.get("active_days", 0),
-                                }
-
-                                conn.execute(
-                                    text(
-                                        """
-                                        INSERT INTO partner_monthly_metrics (
-                                            partner_id,
-                                            month_date,
-                                            orders,
-                                            gmv,
-                                            net_revenue,
-                                            rev_per_gmv,
-                                            channel_share,
-                                            active_days,
-                                            updated_at
-                                        )
-                                        VALUES (
-                                            :partner_id,
-                                            :month_date,
-                                            :orders,
-                                            :gmv,
-                                            :net_revenue,
-                                            :rev_per_gmv,
-                                            :channel_share,
-                                            :active_days,
-                                            NOW()
-                                        )
-                                        ON CONFLICT (partner_id, month_date) DO UPDATE SET
-                                            orders        = EXCLUDED.orders,
-                                            gmv           = EXCLUDED.gmv,
-                                            net_revenue   = EXCLUDED.net_revenue,
-                                            rev_per_gmv   = EXCLUDED.rev_per_gmv,
-                                            channel_share = EXCLUDED.channel_share,
-                                            active_days   = EXCLUDED.active_days,
-                                            updated_at    = NOW();
-                                        """
-                                    ),
-                                    metric_params,
-                                )
-                                metric_upserts += 1
-                                conn.commit()
-
-                            except Exception as e:
-                                conn.rollback()
-                                error_rows.append({"row_index": int(idx), "external_partner_id": external_id, "error": str(e)})
-
-                    if metric_upserts > 0:
+            elif st.button("Upload & Save Monthly Metrics", key="btn_upload_metrics"):
+                saved = 0
+                staged = 0
+                seen_ids = set()
+                skipped = 0
+                duplicates = 0
+                error_rows = []
+
+                def _save_metrics(conn, rows: pd.DataFrame) -> int:
+                    conn.execute(METRICS_STAGE_SQL)
+                    _copy_df(conn, "tmp_metrics_upload", rows, METRICS_UPLOAD_COLS)
+                    return int(conn.execute(METRICS_UPSERT_SQL, {"month_date": month_date}).rowcount or 0)
+
+                # Like the partner-map upload: the whole file is only parsed now, CSV_CHUNK_ROWS
+                # at a time, all on one transaction.
+                uploaded_file.seek(0)
+                progress = st.progress(0.0, text="Saving monthly metrics…")
+                try:
+                    # C engine: pyarrow can't stream chunks. usecols skips parsing the
+                    # sheet's extra report columns, which the upload never stores.
+                    reader = pd.read_csv(
+                        uploaded_file,
+                        chunksize=CSV_CHUNK_ROWS,
+                        dtype=str,
+                        usecols=lambda c: _csv_key(c) in METRICS_CSV_RENAME,
+                    )
+                    with get_transaction() as conn:
+                        for raw_chunk in reader:
+                            batch = _prepare_metrics_chunk(raw_chunk)
+                            valid = batch["external_partner_id"].notna()
+                            skipped += int((~valid).sum())
+                            # One statement can't upsert the same partner twice; last row wins like before.
+                            batch = batch[valid].drop_duplicates(subset="external_partner_id", keep="last")
+                            new_ids = _count_new_ids(batch, seen_ids)
+                            duplicates += int(valid.sum()) - new_ids
+                            staged += new_ids
+                            saved += _save_in_chunks(conn, batch, _save_metrics, error_rows)
+                            _advance_upload_progress(progress, uploaded_file)
+                except Exception as e:
+                    # A parse error part-way through rolls the whole file back.
+                    st.error(f"Upload failed, nothing was saved: {e}")
+                    progress.empty()
+                else:
+                    progress.empty()
+                    # The upsert skips rows whose values didn't change, so saved only
+                    # counts real inserts/updates.
+                    unchanged = max(staged - saved - len(error_rows), 0)
+
+                    fetch_work_items_for_agent.clear()
+                    get_user_portfolio.clear()
+
+                    if saved > 0:
                         st.success(
-                            f"✅ Created/updated {partner_upserts} partners and "
-                            f"{metric_upserts} monthly metric rows for {month_date.strftime('%Y-%m')}."
+                            f"✅ Created/updated {saved} monthly metric rows "
+                            f"for {month_date.strftime('%Y-%m')}."
                         )
+                    if unchanged:
+                        st.info(f"{unchanged} rows were already up to date.")
+                    if skipped:
+                        st.info(f"Skipped {skipped} rows with no Partner ID.")
+                    if duplicates:
+                        st.info(f"Merged {duplicates} duplicate Partner ID rows (the last one was kept).")
 
                     if error_rows:
                         st.warning(f"{len(error_rows)} rows failed. They were skipped; details below.")
-                        st.dataframe(pd.DataFrame(error_rows), use_container_width=True)
+                        st.dataframe(pd.DataFrame(error_rows, columns=ERROR_ROW_COLUMNS), use_container_width=True)
 
-    st.divider()
 
+@st.fragment
+def _render_partner_map_upload(manager_mode=False):
     # -------------------------------
     # B) Add/Map partners to logged-in agent
     # -------------------------------
     
     if manager_mode:
+        # The agent list is cached for an hour; this picks up a newly added agent now.
+        if st.button("↻ Refresh agents", key="refresh_agents_upload"):
+            fetch_central_farmers.clear()
         agent_df = fetch_central_farmers()
-        agent_map = {r["name"]: r["id"] for _, r in agent_df.iterrows()}
+        agent_map = dict(zip(agent_df["name"], agent_df["id"]))
         selected_agent_name = st.selectbox("Assign To Agent", list(agent_map.keys()))
         selected_agent_id = agent_map[selected_agent_name]
     else:
@@ -1196,130 +1736,85 @@ def render_upload_tab(manager_mode=False):
         return
 
     try:
-        raw_p = pd.read_csv(partner_file)
+        raw_p = _parse_csv(partner_file.getvalue(), nrows=50, dtype=str)
     except Exception as e:
         st.error(f"Error reading CSV: {e}")
         return
 
     st.write("Preview:")
-    st.dataframe(raw_p.head(50), use_container_width=True)
-
-    p_df = raw_p.rename(
-        columns={
-            "Partner ID": "external_partner_id",
-            "Partner Name": "partner_name",
-            "Phone Num": "phone",
-            "Partner Type": "partner_type",
-            "Wallet Amount": "wallet_amount",
-            "City": "city",
-            "Type": "partner_type_tag",
-            "Partner Segment": "partner_type_tag",
-            "Partner Tag": "partner_type_tag",
-        }
-    )
+    st.dataframe(raw_p, use_container_width=True)
 
     required = ["external_partner_id", "partner_name"]
-    missing_req = [c for c in required if c not in p_df.columns]
+    missing_req = [c for c in required if c not in _rename_csv_columns(raw_p, PARTNER_CSV_RENAME).columns]
     if missing_req:
         st.error(f"Missing required columns: {missing_req}.")
         return
 
-    p_df["external_partner_id"] = p_df["external_partner_id"].astype(str).str.strip()
-    if "partner_type" in p_df.columns:
-        p_df["partner_type"] = p_df["partner_type"].apply(_normalize_partner_type)
-
-    if "wallet_amount" in p_df.columns:
-        p_df["wallet_amount"] = pd.to_numeric(p_df["wallet_amount"], errors="coerce").fillna(0)
-
-    if "partner_type_tag" in p_df.columns:
-        p_df["partner_type_tag"] = p_df["partner_type_tag"].apply(_normalize_partner_type_tag)
-
     if st.button("Add / Map Partners to My Account", key="btn_add_map_partners"):
-        user = st.session_state.current_user
+        fingerprint = _upload_fingerprint(partner_file.getvalue(), selected_agent_id)
+        if st.session_state.get("last_upload_hash") == fingerprint:
+            st.info("This file was already mapped to this agent. Nothing to do.")
+            return
+
         mapped = 0
         skipped = 0
+        duplicates = 0
+        unique_ids = 0
+        seen_ids = set()
         failed = []
 
-        with get_connection() as conn:
-            for idx, r in p_df.iterrows():
-                ext = str(r.get("external_partner_id", "")).strip()
-                if not ext or ext.lower() == "nan":
-                    skipped += 1
-                    continue
+        def _save_partners(conn, rows: pd.DataFrame) -> int:
+            conn.execute(PARTNER_STAGE_SQL)
+            _copy_df(conn, "tmp_partner_upload", rows, PARTNER_MAP_COLS)
+            return int(conn.execute(PARTNER_UPSERT_MAP_SQL, {"agent_id": selected_agent_id}).rowcount or 0)
 
-                try:
-                    partner_sql = text(
-                        """
-                        INSERT INTO partner (
-                          external_partner_id,
-                          partner_name,
-                          city,
-                          phone,
-                          partner_type,
-                          wallet_amount,
-                          partner_type_tag,
-                          updated_at
-                        )
-                        VALUES (
-                          :external_partner_id,
-                          :partner_name,
-                          :city,
-                          :phone,
-                          :partner_type,
-                          :wallet_amount,
-                          :partner_type_tag,
-                          NOW()
-                        )
-                        ON CONFLICT (external_partner_id) DO UPDATE SET
-                          partner_name      = EXCLUDED.partner_name,
-                          city              = EXCLUDED.city,
-                          phone             = EXCLUDED.phone,
-                          partner_type      = EXCLUDED.partner_type,
-                          wallet_amount     = EXCLUDED.wallet_amount,
-                          partner_type_tag  = COALESCE(EXCLUDED.partner_type_tag, partner.partner_type_tag),
-                          updated_at        = NOW()
-                        RETURNING id;
-                        """
-                    )
-
-                    partner_params = {
-                        "external_partner_id": ext,
-                        "partner_name": r.get("partner_name"),
-                        "city": r.get("city"),
-                        "phone": r.get("phone"),
-                        "partner_type": r.get("partner_type"),
-                        "wallet_amount": float(r.get("wallet_amount", 0)),
-                        "partner_type_tag": r.get("partner_type_tag"),
-                    }
-
-                    partner_id = conn.execute(partner_sql, partner_params).scalar()
-
-                    map_sql = text(
-                        """
-                        INSERT INTO partner_agent_map (partner_id, agent_id)
-                        VALUES (:partner_id, :agent_id)
-                        ON CONFLICT DO NOTHING;
-                        """
-                    )
-                    map_res = conn.execute(map_sql, {
-                      "partner_id": partner_id,
-                      "agent_id": selected_agent_id
-                    })
-                    mapped += int(map_res.rowcount or 0)
-
-                    conn.commit()
-
-                except Exception as e:
-                    conn.rollback()
-                    failed.append({"row_index": int(idx), "external_partner_id": ext, "error": str(e)})
-
-        st.success(f"✅ Done. Mappings created: {mapped}, skipped: {skipped}.")
+        # The full file is only parsed now, CSV_CHUNK_ROWS at a time, so memory
+        # stays bounded by one chunk rather than the whole upload.
+        partner_file.seek(0)
+        progress = st.progress(0.0, text="Mapping partners…")
+        try:
+            reader = pd.read_csv(
+                partner_file,
+                chunksize=CSV_CHUNK_ROWS,
+                dtype=str,
+                usecols=lambda c: _csv_key(c) in PARTNER_CSV_RENAME,
+            )
+            with get_transaction() as conn:
+                for raw_chunk in reader:
+                    batch = _prepare_partner_chunk(raw_chunk)
+                    valid = batch["external_partner_id"].notna()
+                    skipped += int((~valid).sum())
+                    batch = batch[valid].drop_duplicates(subset="external_partner_id", keep="last")
+                    new_ids = _count_new_ids(batch, seen_ids)
+                    duplicates += int(valid.sum()) - new_ids
+                    unique_ids += new_ids
+                    mapped += _save_in_chunks(conn, batch, _save_partners, failed)
+                    _advance_upload_progress(progress, partner_file)
+        except Exception as e:
+            # A parse error part-way through rolls the whole file back.
+            st.error(f"Upload failed, nothing was saved: {e}")
+            return
+        finally:
+            progress.empty()
+
+        fetch_work_items_for_agent.clear()
+        get_user_portfolio.clear()
+        # The mapping insert's rowcount only counts new pairs (ON CONFLICT DO NOTHING), so
+        # the rest of the saved rows were mapped to this agent already.
+        already = max(unique_ids - mapped - len(failed), 0)
+        st.success(f"✅ Done. Mappings created: {mapped}, already mapped: {already}, skipped: {skipped}.")
+        if duplicates:
+            st.info(f"Merged {duplicates} duplicate Partner ID rows (the last one was kept).")
+        if not failed:
+            # Only remember clean ingests, so a file with failed rows can be retried as-is.
+            st.session_state.last_upload_hash = fingerprint
         if failed:
             st.warning(f"{len(failed)} rows failed.")
-            st.dataframe(pd.DataFrame(failed), use_container_width=True)
+            st.dataframe(pd.DataFrame(failed, columns=ERROR_ROW_COLUMNS), use_container_width=True)
 
         st.info("These partners will show on today’s board immediately.")
 
+
 # Dashboard UI
 def render_agent_dashboard():
     user = st.session_state.current_user
@@ -1338,8 +1833,10 @@ def render_agent_dashboard():
 
     agent_filter = None
     if is_leader:
+        if st.button("↻ Refresh agents", key="refresh_agents_dashboard"):
+            fetch_central_farmers.clear()
         agent_df = fetch_central_farmers()
-        agent_map = {r["name"]: r["id"] for _, r in agent_df.iterrows()}
+        agent_map = dict(zip(agent_df["name"], agent_df["id"]))
         selected = st.selectbox("Select Agent", ["All"] + list(agent_map.keys()))
         if selected != "All":
             agent_filter = agent_map[selected]
@@ -1410,8 +1907,8 @@ def _fetch_manager_kpis(start_date: date, end_date: date) -> pd.DataFrame:
             COUNT(DISTINCT agent_id)                                                   AS active_agents
         FROM base;
     """)
-    with get_connection() as conn:
-        return pd.read_sql(q, conn, params={"start_date": start_date, "end_date": end_date})
+    with get_ro_connection() as conn:
+        return _fetch_df(conn, q, {"start_date": start_date, "end_date": end_date})
 
 
 def _fetch_manager_daily_trend(start_date: date, end_date: date) -> pd.DataFrame:
@@ -1430,8 +1927,8 @@ def _fetch_manager_daily_trend(start_date: date, end_date: date) -> pd.DataFrame
         GROUP BY wal.created_at::date, wal.agent_id, COALESCE(wal.agent_name, au.name)
         ORDER BY activity_date, agent_name;
     """)
-    with get_connection() as conn:
-        return pd.read_sql(q, conn, params={"start_date": start_date, "end_date": end_date})
+    with get_ro_connection() as conn:
+        return _fetch_df(conn, q, {"start_date": start_date, "end_date": end_date})
 
 
 def _fetch_manager_agent_day_table(start_date: date, end_date: date) -> pd.DataFrame:
@@ -1493,12 +1990,8 @@ def _fetch_manager_agent_day_table(start_date: date, end_date: date) -> pd.DataF
         ORDER BY d.activity_date DESC, a.agent_name;
     """)
 
-    with get_connection() as conn:
-        return pd.read_sql(
-            q,
-            conn,
-            params={"start_date": start_date, "end_date": end_date},
-        )
+    with get_ro_connection() as conn:
+        return _fetch_df(conn, q, {"start_date": start_date, "end_date": end_date})
 
 
 def render_manager_dashboard():
@@ -1591,20 +2084,18 @@ def render_portfolio():
     st.markdown("### My Portfolio")
     st.caption(f"Summary of all accounts owned by **{user['name']}**")
 
-    if st.button("⬅ Back to Accounts Board"):
+    back_col, refresh_col = st.columns([1, 1])
+    if back_col.button("⬅ Back to Accounts Board"):
         st.session_state.show_portfolio = False
         st.rerun()
+    if refresh_col.button("↻ Refresh", key="portfolio_refresh"):
+        get_user_portfolio.clear()
 
     df = get_user_portfolio(user["email"])
     if df.empty:
         st.info("No partners found in your portfolio.")
         return
 
-    numeric_cols = ["last_month_revenue", "last_month_orders", "mtd_revenue", "mtd_orders"]
-    for c in numeric_cols:
-        if c in df.columns:
-            df[c] = pd.to_numeric(df[c], errors="coerce").fillna(0)
-
     st.dataframe(df, use_container_width=True, hide_index=True)
 
 